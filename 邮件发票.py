@@ -1,81 +1,160 @@
 import os
 import re
-import pandas as pd
+import tempfile
 from email import policy
 from email.parser import BytesParser
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import ahocorasick
+import xxhash
+from fast_langdetect.ft_detect.infer import load_model
 
-def is_russian_text(text):
-    """通过字符频率分析检测文本是否为俄文"""
-    if not text:
-        return False
-    
-    # 俄文字母表（包括大小写）
-    russian_chars = set('абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
-                        'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ')
-    
-    # 计算文本中俄文字符的比例
-    russian_count = sum(1 for char in text if char in russian_chars)
-    total_count = len(text.strip())
-    
-    if total_count == 0:
-        return False
-    
-    # 如果俄文字符比例超过30%，则认为是俄文文本
-    return (russian_count / total_count) > 0.3
-
-def is_russian_pdf(pdf_path):
-    """检查PDF文件是否包含俄文内容（使用简单的PDF文本提取）"""
-    try:
-        # 尝试简单的PDF文本提取
-        text = ""
-        with open(pdf_path, 'rb') as f:
-            content = f.read()
-            # 尝试提取可能的文本部分
-            try:
-                # 尝试解码为UTF-8
-                text = content.decode('utf-8', errors='ignore')
-            except UnicodeDecodeError:
-                # 尝试解码为Latin-1
-                text = content.decode('latin-1', errors='ignore')
-        
-        # 通过字符频率分析检测语言
-        return is_russian_text(text)
-    except Exception as e:
-        print(f"Error reading PDF {pdf_path}: {e}")
-        return False
+# 公司名称常见词汇：ООО 有限责任公司、ЗАО 封闭式股份公司、ПАО 开放式股份公司、ИП 个体经营者
+_VENDOR_PREFIXES = ('ООО', 'ЗАО', 'ПАО', 'ИП')
+
+def _build_vendor_automaton():
+    """构建公司前缀的Aho-Corasick自动机，一次扫描即可找到所有前缀"""
+    automaton = ahocorasick.Automaton()
+    for prefix in _VENDOR_PREFIXES:
+        automaton.add_word(prefix, prefix)
+    automaton.make_automaton()
+    return automaton
+
+_VENDOR_AUTOMATON = _build_vendor_automaton()
+# 邮件可能带有PDF附件的特征：PDF/二进制附件类型，或 .pdf 文件名
+# （经RFC 2047编码的文件名看不出后缀，其附件通常为 application/octet-stream）
+_PDF_HINT_RE = re.compile(rb'(?i)application/(?:pdf|octet-stream)|\.pdf')
+# 金额格式如: 123 456,78 或 123456,78 或 123456
+# 只匹配ASCII数字；千分位分隔符为空格、不间断空格或窄不间断空格（不跨行、不含制表符）
+_AMOUNT_RE = re.compile(r'\d{1,3}(?:[ \xa0\u202f]?\d{3})*(?:,\d{2})?', re.ASCII)
+# 俄文字母表（包括大小写）
+_RUSSIAN_CHAR_RE = re.compile(r'[а-яА-ЯёЁ]')
+
+# 语言检测只取文本开头部分，短样本即可满足判断
+LANG_SAMPLE_CHARS = 4096
+# 对应的解码字节数（UTF-8中俄文字母占2字节）
+LANG_SAMPLE_BYTES = 2 * LANG_SAMPLE_CHARS
+# EML数量达到该值时改用Numba编译的金额解析
+JIT_MIN_BATCH = 1000
+# 每个工作进程一次处理的EML数量，批内PDF的语言检测合并为一次模型调用
+EML_BATCH_SIZE = 32
+# 本脚本路径（导入时解析为绝对路径），用于中间结果的命名和新旧判断
+_SCRIPT_PATH = os.path.abspath(__file__)
+# 当前进程的umask（只能通过设置来读取，读取后立即恢复）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def extract_pdf_text(pdf_bytes, max_bytes=None):
+    """提取PDF文本内容（使用简单方法）；指定max_bytes时只解码开头部分"""
+    # errors='ignore' 时解码不会失败，无需回退到Latin-1
+    return pdf_bytes[:max_bytes].decode('utf-8', errors='ignore')
+
+def lang_sample(text):
+    """取文本开头的采样窗口用于语言检测；采样中没有俄文字母时返回None"""
+    sample = text[:LANG_SAMPLE_CHARS]
+    # 采样中没有任何俄文字母时无需调用模型
+    if not _RUSSIAN_CHAR_RE.search(sample):
+        return None
+    
+    # fast-langdetect 不接受换行符，检测前替换为空格
+    return sample.replace('\n', ' ').strip()
+
+def detect_russian_batch(samples):
+    """使用FastText批量检测文本是否为俄文"""
+    if not samples:
+        return []
+    # FastText模型由fast_langdetect在模块级缓存，每个进程只加载一次。
+    # fasttext-predict的predict对列表输入的返回值解包有误，因此直接调用底层的
+    # multilinePredict，整批样本（每条一行，样本内已无换行）一次完成预测
+    model = load_model(low_memory=True)
+    labels = model.f.multilinePredict([sample + '\n' for sample in samples], 1, 0.0, 'strict')
+    return [bool(label) and label[0] == '__label__ru' for label in labels]
+
+def parse_amount(buf):
+    """逐字节扫描UTF-8文本中的第一个金额，规则与_AMOUNT_RE一致，未找到时返回-1.0
+    
+    Numba无法使用re模块，因此手写状态机；千分位分隔符支持空格、
+    不间断空格(C2 A0)和窄不间断空格(E2 80 AF)。
+    """
+    n = len(buf)
+    i = 0
+    while i < n and not (48 <= buf[i] <= 57):
+        i += 1
+    if i == n:
+        return -1.0
+    
+    # 整数部分开头的1~3位数字
+    value = 0.0
+    j = i
+    while j < n and j - i < 3 and 48 <= buf[j] <= 57:
+        value = value * 10 + (buf[j] - 48)
+        j += 1
+    
+    # 后续每组：可选的一个空白分隔符 + 3位数字
+    while True:
+        k = j
+        if k < n and buf[k] == 32:
+            k += 1
+        elif k + 1 < n and buf[k] == 0xC2 and buf[k + 1] == 0xA0:
+            k += 2
+        elif k + 2 < n and buf[k] == 0xE2 and buf[k + 1] == 0x80 and buf[k + 2] == 0xAF:
+            k += 3
+        if (k + 2 < n and 48 <= buf[k] <= 57 and 48 <= buf[k + 1] <= 57
+                and 48 <= buf[k + 2] <= 57):
+            value = value * 1000 + ((buf[k] - 48) * 100 + (buf[k + 1] - 48) * 10
+                                    + (buf[k + 2] - 48))
+            j = k + 3
+        else:
+            break
+    
+    # 可选的小数部分：逗号 + 2位数字
+    if j + 2 < n and buf[j] == 44 and 48 <= buf[j + 1] <= 57 and 48 <= buf[j + 2] <= 57:
+        cents = value * 100 + ((buf[j + 1] - 48) * 10 + (buf[j + 2] - 48))
+        return cents / 100
+    return value
+
+_jit_parse_amount = None
 
-def extract_amount(text):
+def get_jit_parse_amount():
+    """返回Numba编译后的parse_amount（首次调用时编译，结果缓存到磁盘）"""
+    global _jit_parse_amount
+    if _jit_parse_amount is None:
+        from numba import njit
+        _jit_parse_amount = njit(cache=True)(parse_amount)
+        _jit_parse_amount(b'0')  # 立即触发编译（或加载磁盘缓存）
+    return _jit_parse_amount
+
+def extract_amount(text, use_jit=False):
     """从文本中提取金额信息，支持俄文数字格式"""
-    # 匹配格式如: 123 456,78 或 123456,78 或 123456
-    patterns = [
-        r'(\d{1,3}(?:\s?\d{3})*(?:,\d{2})?)',  # 带千分位和小数点
-        r'(\d+(?:,\d{2})?)',                   # 带小数点
-        r'(\d+)'                               # 整数
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            amount_str = match.group(1).replace(' ', '').replace(',', '.')
-            try:
-                return float(amount_str)
-            except ValueError:
-                continue
+    if use_jit:
+        # 批量处理时使用Numba编译的逐字节扫描
+        amount = get_jit_parse_amount()(text.encode('utf-8'))
+        return amount if amount >= 0 else None
+    
+    match = _AMOUNT_RE.search(text)
+    if match:
+        # 去掉千分位分隔符（包括不间断空格），逗号换成小数点
+        amount_str = ''.join(match.group().split()).replace(',', '.')
+        return float(amount_str)
     return None
 
 def extract_vendor(text):
     """从文本中提取供应商信息（简化版）"""
-    # 简单匹配公司名称常见词汇
-    company_patterns = [
-        r'ООО\s+([^\n]+)',  # 有限责任公司
-        r'ЗАО\s+([^\n]+)',  # 封闭式股份公司
-        r'ПАО\s+([^\n]+)',  # 开放式股份公司
-        r'ИП\s+([^\n]+)',   # 个体经营者
-    ]
-    for pattern in company_patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(1).strip()
+    # 简单匹配公司名称常见词汇：前缀后须为空白（可跨行），名称取其后到行尾的内容
+    n = len(text)
+    for end, _ in _VENDOR_AUTOMATON.iter(text):
+        start = end + 1
+        if start >= n or not text[start].isspace():
+            continue
+        while start < n and text[start].isspace():
+            start += 1
+        if start == n:
+            continue
+        line_end = text.find('\n', start)
+        if line_end == -1:
+            line_end = n
+        return text[start:line_end].strip()
     
     # 如果没有匹配到公司格式，尝试提取其他可能的供应商名称
     # 这里使用启发式方法，提取大写字母开头的连续单词
@@ -86,6 +165,181 @@ def extract_vendor(text):
     
     return "Неизвестный поставщик"  # 未知供应商
 
+def save_pdf_attachments(eml_path, temp_pdf_folder):
+    """解析单个eml文件并保存其中的PDF附件，返回[(PDF文件名, 保存路径, 附件内容)]"""
+    attachments = []
+    with open(eml_path, 'rb') as f:
+        raw = f.read()
+    
+    # 没有任何PDF特征的邮件直接跳过，省去完整的MIME解析
+    if not _PDF_HINT_RE.search(raw):
+        return attachments
+    
+    # 解析eml文件
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    
+    # 遍历邮件中的所有附件
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+        if part.get('Content-Disposition') is None:
+            continue
+        
+        filename = part.get_filename()
+        if filename and filename.lower().endswith('.pdf'):
+            # 保存PDF附件副本，解析时直接使用内存中的内容，不再从磁盘回读
+            payload = part.get_payload(decode=True)
+            pdf_path = os.path.join(temp_pdf_folder, filename)
+            # 多个进程可能同时保存同名附件：先写临时文件，再原子替换到目标位置
+            fd, tmp_path = tempfile.mkstemp(dir=temp_pdf_folder, suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(payload)
+                # mkstemp创建的文件权限为0600，改回普通新建文件的默认权限
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+                os.replace(tmp_path, pdf_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            attachments.append((filename, pdf_path, payload))
+    return attachments
+
+# 已解析附件的内容摘要 -> (供应商, 金额)，非俄文PDF记为None；每个工作进程各自维护
+_parsed_pdfs = {}
+
+def process_eml_batch(eml_paths, temp_pdf_folder, use_jit=False):
+    """处理一批eml文件，返回其中俄文PDF附件的(供应商, 金额, PDF文件名, 来源EML)列表"""
+    # 第一遍：保存所有附件，并为未解析过的附件提取语言检测样本
+    attachments = []  # (附件摘要, PDF文件名, 来源EML)
+    pending = {}      # 附件摘要 -> (附件内容, 保存路径, 检测样本)
+    for eml_path in eml_paths:
+        try:
+            saved = save_pdf_attachments(eml_path, temp_pdf_folder)
+        except Exception as e:
+            print(f"Error processing {eml_path}: {e}")
+            continue
+        
+        for filename, pdf_path, payload in saved:
+            # 相同内容的附件（转发、抄送的重复发票）只解析一次
+            digest = xxhash.xxh3_64_intdigest(payload)
+            if digest not in _parsed_pdfs and digest not in pending:
+                try:
+                    sample = lang_sample(extract_pdf_text(payload, LANG_SAMPLE_BYTES))
+                except Exception as e:
+                    print(f"Error reading PDF {pdf_path}: {e}")
+                    continue
+                if sample is None:
+                    # 样本不足以判断语言的附件不是候选，不必保留其内容等待检测
+                    _parsed_pdfs[digest] = None
+                else:
+                    pending[digest] = (payload, pdf_path, sample)
+            attachments.append((digest, filename, eml_path))
+    
+    # 第二遍：整批样本一次送入FastText模型
+    is_russian = detect_russian_batch([sample for _, _, sample in pending.values()])
+    russian_digests = {digest for digest, russian in zip(pending, is_russian) if russian}
+    
+    # 第三遍：只对俄文PDF提取全部文本，再提取供应商和金额
+    for digest, (payload, pdf_path, _) in pending.items():
+        if digest not in russian_digests:
+            _parsed_pdfs[digest] = None
+            continue
+        try:
+            text = extract_pdf_text(payload)
+        except Exception as e:
+            print(f"Error reading PDF {pdf_path}: {e}")
+            continue
+        _parsed_pdfs[digest] = (extract_vendor(text), extract_amount(text, use_jit))
+    
+    pdf_data = []
+    for digest, filename, eml_path in attachments:
+        result = _parsed_pdfs.get(digest)
+        if result is not None:
+            vendor, amount = result
+            pdf_data.append((vendor, amount, filename, eml_path))
+    return pdf_data
+
+def extract_invoice_data(eml_paths, temp_pdf_folder):
+    """并行处理所有eml文件，返回(明细DataFrame, 供应商汇总DataFrame)；没有俄文PDF时返回None"""
+    # EML数量足够多时才启用Numba编译的金额解析，以摊薄JIT编译开销；
+    # 先在主进程中编译，缓存结果供各工作进程复用
+    use_jit = len(eml_paths) >= JIT_MIN_BATCH
+    if use_jit:
+        get_jit_parse_amount()
+    
+    # 按列存储PDF文件信息
+    vendors, amounts, pdf_files, source_emls = [], [], [], []
+    # 边收集边累计各供应商总金额
+    vendor_totals = defaultdict(float)
+    # 各eml文件相互独立，分批交给多个进程并行处理；
+    # 文件较少时减小批量，保证每个进程都有任务
+    workers = os.cpu_count() or 1
+    batch_size = max(1, min(EML_BATCH_SIZE, -(-len(eml_paths) // workers)))
+    batches = [eml_paths[i:i + batch_size]
+               for i in range(0, len(eml_paths), batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(process_eml_batch, batches,
+                               repeat(temp_pdf_folder), repeat(use_jit))
+        for records in results:
+            for vendor, amount, filename, eml_path in records:
+                vendors.append(vendor)
+                amounts.append(amount)
+                pdf_files.append(filename)
+                source_emls.append(eml_path)
+                vendor_totals[vendor] += amount or 0.0
+    
+    if not vendors:
+        return None
+    
+    # pandas/numpy只在汇总时才需要，延迟导入以免每个工作进程启动时都加载
+    import numpy as np
+    import pandas as pd
+    
+    # 直接按列构建并指定类型，供应商重复较多，使用分类类型
+    df = pd.DataFrame({
+        '供应商': pd.Categorical(vendors),
+        '金额': np.asarray(amounts, dtype='float64'),
+        'PDF文件名': pdf_files,
+        '来源EML': source_emls
+    })
+    
+    # 供应商汇总直接由累计结果生成（按供应商排序）
+    summary_vendors = sorted(vendor_totals)
+    vendor_summary = pd.DataFrame({
+        '供应商': summary_vendors,
+        '金额': [vendor_totals[vendor] for vendor in summary_vendors]
+    })
+    return df, vendor_summary
+
+def write_excel_report(detail_path, summary_path, excel_path):
+    """由Parquet中间结果生成Excel报表，只负责展示格式"""
+    import pandas as pd
+    
+    df = pd.read_parquet(detail_path)
+    vendor_summary = pd.read_parquet(summary_path)
+    
+    # 创建ExcelWriter对象
+    with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
+        # 写入详细数据
+        df.to_excel(writer, sheet_name='详细数据', index=False)
+        
+        # 写入供应商汇总
+        vendor_summary.to_excel(writer, sheet_name='供应商汇总', index=False)
+        
+        # 获取工作簿和工作表对象以进行格式设置
+        workbook = writer.book
+        worksheet_detail = writer.sheets['详细数据']
+        worksheet_summary = writer.sheets['供应商汇总']
+        
+        # 设置金额列格式为货币格式
+        money_format = workbook.add_format({'num_format': '#,##0.00'})
+        amount_idx = df.columns.get_loc('金额')
+        worksheet_detail.set_column(amount_idx, amount_idx, 15, money_format)
+        
+        # 设置汇总表的金额列格式
+        amount_idx = vendor_summary.columns.get_loc('金额')
+        worksheet_summary.set_column(amount_idx, amount_idx, 15, money_format)
+
 def process_eml_files(folder_path):
     """处理邮件文件夹中的所有eml文件"""
     if not os.path.exists(folder_path):
@@ -96,99 +350,47 @@ def process_eml_files(folder_path):
     temp_pdf_folder = os.path.join(os.getcwd(), "extracted_pdfs")
     os.makedirs(temp_pdf_folder, exist_ok=True)
     
-    pdf_data = []  # 存储PDF文件信息
+    with os.scandir(folder_path) as entries:
+        eml_entries = [entry for entry in entries
+                       if entry.is_file() and entry.name.lower().endswith('.eml')]
     
-    # 处理所有eml文件
-    for filename in os.listdir(folder_path):
-        if filename.lower().endswith('.eml'):
-            eml_path = os.path.join(folder_path, filename)
-            try:
-                # 解析eml文件
-                with open(eml_path, 'rb') as f:
-                    msg = BytesParser(policy=policy.default).parse(f)
-                
-                # 遍历邮件中的所有附件
-                for part in msg.walk():
-                    if part.get_content_maintype() == 'multipart':
-                        continue
-                    if part.get('Content-Disposition') is None:
-                        continue
-                    
-                    filename = part.get_filename()
-                    if filename and filename.lower().endswith('.pdf'):
-                        # 保存PDF附件
-                        pdf_path = os.path.join(temp_pdf_folder, filename)
-                        with open(pdf_path, 'wb') as fp:
-                            fp.write(part.get_payload(decode=True))
-                        
-                        # 检查是否为俄文PDF
-                        if is_russian_pdf(pdf_path):
-                            # 提取PDF文本内容（使用简单方法）
-                            text = ""
-                            with open(pdf_path, 'rb') as f:
-                                content = f.read()
-                                try:
-                                    text = content.decode('utf-8', errors='ignore')
-                                except UnicodeDecodeError:
-                                    text = content.decode('latin-1', errors='ignore')
-                            
-                            # 提取供应商和金额
-                            vendor = extract_vendor(text)
-                            amount = extract_amount(text)
-                            
-                            pdf_data.append({
-                                '供应商': vendor,
-                                '金额': amount,
-                                'PDF文件名': filename,
-                                '来源EML': eml_path
-                            })
-            except Exception as e:
-                print(f"Error processing {eml_path}: {e}")
-    
-    # 创建DataFrame并生成Excel
-    if pdf_data:
-        df = pd.DataFrame(pdf_data)
-        
-        # 按供应商分组并计算总金额
-        vendor_summary = df.groupby('供应商')['金额'].sum().reset_index()
-        
-        # 创建ExcelWriter对象
-        excel_path = os.path.join(os.getcwd(), "俄文PDF分类统计.xlsx")
-        with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
-            # 写入详细数据
-            df.to_excel(writer, sheet_name='详细数据', index=False)
-            
-            # 写入供应商汇总
-            vendor_summary.to_excel(writer, sheet_name='供应商汇总', index=False)
-            
-            # 获取工作簿和工作表对象以进行格式设置
-            workbook = writer.book
-            worksheet_detail = writer.sheets['详细数据']
-            worksheet_summary = writer.sheets['供应商汇总']
-            
-            # 设置金额列格式为货币格式
-            money_format = workbook.add_format({'num_format': '#,##0.00'})
-            for col_idx, col_name in enumerate(df.columns):
-                if col_name == '金额':
-                    worksheet_detail.set_column(col_idx, col_idx, 15, money_format)
-            
-            # 设置汇总表的金额列格式
-            for col_idx, col_name in enumerate(vendor_summary.columns):
-                if col_name == '金额':
-                    worksheet_summary.set_column(col_idx, col_idx, 15, money_format)
+    # 中间结果（Parquet）与展示用的Excel分开保存；
+    # 两个脚本的解析方式不同、不同邮件文件夹的结果也不能混用，
+    # 中间结果文件名带上脚本名和邮件文件夹绝对路径的摘要
+    script_name = os.path.splitext(os.path.basename(_SCRIPT_PATH))[0]
+    folder_digest = xxhash.xxh3_64_hexdigest(os.fsencode(os.path.abspath(folder_path)))
+    cache_suffix = f"{script_name}_{folder_digest}"
+    detail_path = os.path.join(os.getcwd(), f"俄文PDF明细_{cache_suffix}.parquet")
+    summary_path = os.path.join(os.getcwd(), f"俄文PDF汇总_{cache_suffix}.parquet")
+    excel_path = os.path.join(os.getcwd(), "俄文PDF分类统计.xlsx")
+    
+    # 中间结果比所有eml文件、邮件文件夹本身及本脚本都新时，跳过PDF解析直接生成Excel
+    latest_input = max([os.stat(folder_path).st_mtime, os.path.getmtime(_SCRIPT_PATH)] +
+                       [entry.stat().st_mtime for entry in eml_entries])
+    extracted = False
+    if all(os.path.exists(path) and os.path.getmtime(path) > latest_input
+           for path in (detail_path, summary_path)):
+        print("邮件没有变化，使用已有的中间结果生成Excel。")
+    else:
+        result = extract_invoice_data([entry.path for entry in eml_entries],
+                                      temp_pdf_folder)
+        if result is None:
+            print("未找到符合条件的俄文PDF文件。")
+            return
         
-        print(f"处理完成！Excel文件已保存至: {excel_path}")
+        df, vendor_summary = result
+        df.to_parquet(detail_path, index=False)
+        vendor_summary.to_parquet(summary_path, index=False)
+        extracted = True
+    
+    write_excel_report(detail_path, summary_path, excel_path)
+    print(f"处理完成！Excel文件已保存至: {excel_path}")
+    if extracted:
         print(f"提取的PDF文件保存在: {temp_pdf_folder}")
-    else:
-        print("未找到符合条件的俄文PDF文件。")
 
 if __name__ == "__main__":
     # 设置邮件文件夹路径
     EMAIL_FOLDER = "邮件"
     
-    # 确保中文显示正常
-    pd.set_option('display.unicode.ambiguous_as_wide', True)
-    pd.set_option('display.unicode.east_asian_width', True)
-    
     # 处理邮件文件
     process_eml_files(EMAIL_FOLDER)    